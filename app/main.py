@@ -1,33 +1,88 @@
 from __future__ import annotations
 
-from fastapi import FastAPI, Request
+import asyncio
+import contextlib
+import time
+from typing import Dict, Optional
+
+from fastapi import FastAPI, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-from .parking_feed import FeedCache
+from .parking_feed import JSON_PAGE, FeedCache, Lots, RenderedPage
 
-app = FastAPI()
 templates = Jinja2Templates(directory="app/templates")
+
+
+# renders the data-dependent pages; the cache calls this once per feed refresh
+def render_pages(lots: Lots) -> Dict[str, str]:
+    return {
+        name: templates.get_template(name).render(lots=lots)
+        for name in ("index.html", "_table.html")
+    }
+
+
+cache = FeedCache(ttl_seconds=15, render=render_pages)
+
+
+# starts the background feed refresh when the app boots and stops it on shutdown
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    task = asyncio.create_task(cache.run_forever())
+    yield
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+
+app = FastAPI(lifespan=lifespan)
+# compresses html/json for clients that send Accept-Encoding: gzip (tiny bodies are sent as is)
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=6)
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
-cache = FeedCache(ttl_seconds=15)
+
+# weak comparison as RFC 9110 wants for If-None-Match: the header may be "*" or a comma
+# separated list of tags, and a W/ prefix on either side is ignored
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    opaque = etag.removeprefix("W/")
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == opaque:
+            return True
+    return False
+
+
+# sends a cached page, or 304 Not Modified if the client already has this version
+def page_response(request: Request, page: RenderedPage, media_type: str = "text/html") -> Response:
+    # lets browsers and proxies reuse the page until the next refresh is due
+    remaining = max(1, int(cache.expires_at - time.time()))
+    headers = {
+        "ETag": page.etag,
+        "Last-Modified": page.last_modified,
+        "Cache-Control": f"public, max-age={remaining}, stale-while-revalidate=30",
+        # GZipMiddleware only adds Vary when it compresses; uncompressed bodies and 304s need it too
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request.headers.get("if-none-match"), page.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=page.body, media_type=media_type, headers=headers)
 
 
 @app.get("/", response_class=HTMLResponse)
-def index(request: Request):
-    lots = cache.get()
-    return templates.TemplateResponse(
-        "index.html",
-        {
-            "request": request,
-            "lots": lots,
-        },
-    )
-
-@app.get("/fragment/parkinglots")
-def fragment_parkinglots(request: Request):
-    return templates.TemplateResponse("_table.html", {
-        "request": request,
-        "lots": cache.get()
-    })
+async def index(request: Request):
+    await cache.aget()
+    return page_response(request, cache.page("index.html"))
+
+@app.get("/fragment/parkinglots", response_class=HTMLResponse)
+async def fragment_parkinglots(request: Request):
+    await cache.aget()
+    return page_response(request, cache.page("_table.html"))
+
+@app.get("/api/lots")
+async def api_lots(request: Request):
+    await cache.aget()
+    return page_response(request, cache.page(JSON_PAGE), media_type="application/json")
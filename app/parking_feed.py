@@ -2,17 +2,56 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Optional, List, Tuple
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from functools import lru_cache
+from operator import itemgetter
+from typing import Callable, Dict, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import threading
 import time
 
-import feedparser
+import lxml.etree as ET
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 FEED_URL = "https://www.pls-zh.ch/plsFeed/rss/"
+log = logging.getLogger(__name__)
+
+FEED_TIMEOUT = (3, 5) # (connect, read) seconds per attempt; with the retries below a refresh gives up after ~35s at most
+
+
+# compiled once: every <item> of the RSS channel
+_ITEM_XP = ET.XPath("./channel/item")
+# entity expansion off: the feed only needs the predefined xml entities
+_XML_PARSER = ET.XMLParser(resolve_entities=False)
+
+
+# one shared HTTP session so the TCP+TLS connection to the feed server is reused between refreshes
+_SESSION = requests.Session()
+_SESSION.headers.update({
+    "Accept-Encoding": "gzip, deflate", # requests decodes compressed bodies transparently
+    "User-Agent": "parking-zh-ai/1.0",
+})
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=4,
+        # only connection and read errors are retried; error statuses (and their Retry-After,
+        # which could otherwise sleep for minutes while holding the cache lock) go straight to raise_for_status
+        max_retries=Retry(total=3, status=0, backoff_factor=0.3, respect_retry_after_header=False),
+    ),
+)
 
 
 # Datamodel class
-@dataclass(frozen=True) # @dataclass adds methods like __init__ frozen=true means once created cant be changed
+@dataclass(frozen=True, slots=True) # @dataclass adds methods like __init__ frozen=true means once created cant be changed, slots=True drops the per-object __dict__
 class ParkingLot:
     name: str
     link: str
@@ -20,7 +59,54 @@ class ParkingLot:
     free_spaces: Optional[int] # this field is either an int or none
     updated_at: Optional[datetime] # this field is either a datetime object or none
 
-# parses the description string
+# the cached snapshot of parking lots; a tuple because it is shared between the refresh thread and the handlers and must never be mutated
+Lots = Tuple[ParkingLot, ...]
+
+
+# a page rendered from the current list of parking lots, ready to be sent as is
+@dataclass(frozen=True)
+class RenderedPage:
+    body: bytes # utf-8 encoded html or json
+    etag: str # weak ETag, a hash of body
+    last_modified: str # http date of the refresh that produced body
+
+
+# turns a list of parking lots into html, keyed by template name
+RenderFn = Callable[[Lots], Dict[str, str]]
+
+# name of the pre-serialized json page, always rendered next to the html pages
+JSON_PAGE = "lots.json"
+
+
+# serializes the lots to json once per refresh
+def _lots_json(lots: Lots) -> bytes:
+    return json.dumps(
+        [
+            {
+                "name": lot.name,
+                "link": lot.link,
+                "status": lot.status,
+                "free_spaces": lot.free_spaces,
+                "updated_at": lot.updated_at.isoformat() if lot.updated_at else None,
+            }
+            for lot in lots
+        ],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+# known raw status strings from the feed, looked up before falling back to .lower()
+_STATUS_MAP = {
+    "open": "open", "Open": "open", "OPEN": "open",
+    "closed": "closed", "Closed": "closed", "CLOSED": "closed",
+    "????": "unknown",
+}
+
+# "status / spaces" with the whitespace around both parts left outside the groups
+_DESC_RE = re.compile(r"\s*([^/]*?)\s*/\s*([^/]*?)\s*\Z")
+
+# parses the description string (pure function of desc, so repeated descriptions like "closed / 0" come from the cache)
+@lru_cache(maxsize=256)
 def _parse_description(desc: str) -> Tuple[str, Optional[int]]:
     """
     Examples:
@@ -32,80 +118,199 @@ def _parse_description(desc: str) -> Tuple[str, Optional[int]]:
     if not desc:
         return "unknown", None
 
-    # turns input into two parts and removes white space ("open / 43" -> ["open", "43"])
-    parts = [p.strip() for p in desc.split("/")]
-    # if length of parts does not equal 2 return lowered and stripped or unkown
-    if len(parts) != 2:
+    # splits "status / spaces" and strips both parts in one C-level match ("open / 43" -> "open", "43")
+    m = _DESC_RE.match(desc)
+    # no match means there is not exactly one "/", return lowered and stripped or unkown
+    if m is None:
         return desc.strip().lower() or "unknown", None
+    status_raw, spaces_raw = m.group(1), m.group(2)
 
-    # takes first element of parts and stores in status_raw and second element of parts and stores in spaces_raw: ["open", "43"] -> status_raw: ["open"], spaces_raw: ["43"]
-    status_raw, spaces_raw = parts[0], parts[1]
+    # common statuses are a single dict lookup
+    status = _STATUS_MAP.get(status_raw)
+    if status is None:
+        # checks if "??" appears in status raw if so returns assigns status="unknown"
+        status = status_raw.lower()
+        if "??" in status_raw:
+            status = "unknown"
 
-    # checks if "??" appears in status raw if so returns assigns status="unknown"
-    status = status_raw.lower()
-    if "??" in status_raw:
-        status = "unknown"
-
-    # trys to convert spaces_raw into int: "43" -> free=43 if that is not possible assigns free=none
-    try:
-        free = int(spaces_raw)
-    except Exception:
-        free = None
+    # converts spaces_raw into int: "43" -> free=43, anything that is not plain digits ("???") -> free=none
+    free = int(spaces_raw) if spaces_raw.isdecimal() else None
 
     # returns a tuple of newly assigned attributes status and free
     return status, free
 
-# parses a entry into a timestamp
-def _parse_dt(entry) -> Optional[datetime]:
-    # feedparser often provides: entry.published_parsed (time.struct_time)
-    t = getattr(entry, "published_parsed", None)
-    if not t:
+# parses an RSS pubDate ("Wed, 15 Oct 2026 10:00:00 +0200") into a UTC timestamp
+def _parse_dt(pub_date: Optional[str]) -> Optional[datetime]:
+    if not pub_date:
+        return None
+    # parsedate_tz gives the fields plus the utc offset, mktime_tz turns them into epoch seconds
+    # with plain calendar.timegm arithmetic (no local timezone lookups; a missing offset means UTC)
+    t = parsedate_tz(pub_date)
+    if t is None:
+        return None
+    try:
+        return datetime.fromtimestamp(mktime_tz(t), tz=timezone.utc)
+    except (OverflowError, OSError, ValueError):
         return None
-    return datetime.fromtimestamp(time.mktime(t), tz=timezone.utc)
 
 # stores parsed data into TTL cache 
 class FeedCache:
     # __init__ runs on object creation 
-    def __init__(self, ttl_seconds: int = 15):
+    def __init__(self, ttl_seconds: int = 15, render: Optional[RenderFn] = None):
         self.ttl_seconds = ttl_seconds # saves the ttl to the object self
         self._expires_at: float = 0.0 # expiration timestamp starts at 0.0
-        self._value: List[ParkingLot] = [] # holds the cached list of parking lots and starts empty 
+        self._value: Lots = () # holds the cached parking lots and starts empty
+        self._etag: Optional[str] = None # ETag header of the last feed response, sent back as If-None-Match
+        self._last_modified: Optional[str] = None # Last-Modified header of the last feed response, sent back as If-Modified-Since
+        self._by_name: Dict[str, ParkingLot] = {} # lots of the last refresh by name, reused when unchanged
+        self._body_hash: Optional[bytes] = None # blake2b digest of the last parsed feed body
+        self._lock = threading.Lock() # makes sure only one caller downloads the feed at a time
+        self._render = render # renders the pages once per refresh instead of once per request
+        self._pages: Dict[str, RenderedPage] = {} # pre-rendered pages by template name
+        self._pages = self._render_pages(self._value) # starts with the empty table
 
     # get method to retrieve parking data which returns a list of ParkingLot objects
-    def get(self) -> List[ParkingLot]:
+    def get(self) -> Lots:
         now = time.time()
-        # if now is lower than expires_at and cached list isnt empty return cached value immediately
-        if now < self._expires_at and self._value:
+        # if now is lower than expires_at return cached value immediately (even an empty one:
+        # a failed or empty refresh is only retried after the ttl)
+        if now < self._expires_at:
             return self._value
 
-        # downloads and parses RSS feed (parsed contains .entries items)
-        parsed = feedparser.parse(FEED_URL)
-
-        #creates empty list called lots and will contain ParkingLot
-        lots: List[ParkingLot] = []
-        # for every entry in parsed
-        for e in parsed.entries:
-            # gets entry description, uses _parse_description to return status and free
-            status, free = _parse_description(getattr(e, "description", ""))
-            lots.append(
-                # builds parkinglot object
-                ParkingLot(
-                    name=getattr(e, "title", "").strip(), # gets name from rss entry and strips
-                    link=getattr(e, "link", "").strip(), # gets link from rss entry and strips
-                    status=status, # assigns parsed status to status
-                    free_spaces=free, # assigns free to free spaces
-                    updated_at=_parse_dt(e), # calls parse dt for entry timestamp
-                )
-            )
+        with self._lock:
+            # another caller may have refreshed while we were waiting for the lock, reuse its result
+            if time.time() < self._expires_at:
+                return self._value
+            return self._refresh_locked()
+
+    # async version of get for the route handlers: after the first refresh the background task keeps the
+    # snapshot fresh, so it is returned even if slightly stale; only a cold start waits for a download, which runs
+    # in a worker thread so the event loop keeps serving other requests
+    async def aget(self) -> Lots:
+        # expires_at is set by every refresh attempt, so 0.0 means nothing has been tried yet
+        if self._expires_at:
+            return self._value
+        return await asyncio.to_thread(self.get)
+
+    # unix time at which the cached snapshot is due for a refresh
+    @property
+    def expires_at(self) -> float:
+        return self._expires_at
+
+    # the pre-rendered page for a template name, rendered at the last refresh
+    def page(self, name: str) -> RenderedPage:
+        return self._pages[name]
+
+    # renders the json page plus every html page of the render function for the given lots
+    def _render_pages(self, lots: Lots) -> Dict[str, RenderedPage]:
+        bodies: Dict[str, bytes] = {JSON_PAGE: _lots_json(lots)}
+        if self._render is not None:
+            for name, html in self._render(lots).items():
+                bodies[name] = html.encode("utf-8")
+
+        last_modified = formatdate(time.time(), usegmt=True)
+        pages: Dict[str, RenderedPage] = {}
+        for name, body in bodies.items():
+            # weak: GZipMiddleware may send the same page gzip-encoded, and a strong tag would have to differ per encoding
+            etag = 'W/"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+            prev = self._pages.get(name)
+            # same body as before: keep the old page so Last-Modified does not move
+            if prev is not None and prev.etag == etag:
+                pages[name] = prev
+            else:
+                pages[name] = RenderedPage(body=body, etag=etag, last_modified=last_modified)
+        return pages
+
+    # background task: refreshes the cache every ttl_seconds so requests never wait for the feed
+    async def run_forever(self) -> None:
+        while True:
+            try:
+                # the download and parsing are blocking, so they run in a worker thread; get() skips
+                # the download if a cold-start request already refreshed while we waited for the lock
+                await asyncio.to_thread(self.get)
+            except Exception:
+                log.exception("refreshing the parking feed failed")
+            await asyncio.sleep(self.ttl_seconds)
+
+    # downloads and parses the feed, then swaps the new list into the cache (caller holds self._lock)
+    def _refresh_locked(self) -> Lots:
+        now = time.time()
 
-        # Sort: open first, then by most free spaces
-        def sort_key(x: ParkingLot):
-            open_rank = 0 if x.status == "open" else 1 # open comes first
-            free_rank = -(x.free_spaces if x.free_spaces is not None else -1) # then sorts by descending parking spaces
-            return (open_rank, free_rank, x.name.lower())
+        # conditional GET: only ask for the body if it changed since our last download
+        headers = {}
+        if self._etag:
+            headers["If-None-Match"] = self._etag
+        if self._last_modified:
+            headers["If-Modified-Since"] = self._last_modified
 
-        lots.sort(key=sort_key)
+        try:
+            resp = _SESSION.get(FEED_URL, headers=headers, timeout=FEED_TIMEOUT)
+            resp.raise_for_status()
+        except requests.RequestException:
+            # feed unreachable: keep serving the old list and try again after the next ttl
+            self._expires_at = now + self.ttl_seconds
+            return self._value
+
+        # 304 Not Modified: nothing changed upstream, so the cached list is still correct
+        if resp.status_code == 304:
+            self._expires_at = now + self.ttl_seconds
+            return self._value
+
+        # same bytes as last time (server ignored the conditional GET): skip parsing and sorting
+        body = resp.content
+        body_hash = hashlib.blake2b(body, digest_size=16).digest()
+        if body_hash == self._body_hash:
+            self._remember_validators(resp)
+            self._expires_at = now + self.ttl_seconds
+            return self._value
+
+        # parses the downloaded RSS body with libxml2
+        try:
+            root = ET.fromstring(body, _XML_PARSER)
+        except ET.XMLSyntaxError:
+            # broken feed: keep serving the old list and try again after the next ttl
+            log.warning("parking feed is not valid XML, keeping the cached list")
+            self._expires_at = now + self.ttl_seconds
+            return self._value
+
+        # local aliases skip the global lookups inside the comprehension
+        _pd, _dt, _PL = _parse_description, _parse_dt, ParkingLot
+        # builds one (sort key, ParkingLot) pair per item; status and free come from the parsed description
+        # sort key: open first, then by most free spaces, then by name
+        keyed = [
+            (
+                (0 if status == "open" else 1, -(free if free is not None else -1), name.lower()),
+                _PL(
+                    name=name,
+                    link=item.findtext("link", "").strip(),
+                    status=status,
+                    free_spaces=free,
+                    updated_at=_dt(item.findtext("pubDate")),
+                ),
+            )
+            for item in _ITEM_XP(root)
+            for status, free in (_pd(item.findtext("description", "")),)
+            for name in (item.findtext("title", "").strip(),)
+        ]
+        # sorts on the precomputed keys only, so the lots themselves are never compared
+        keyed.sort(key=itemgetter(0))
+        # keeps the previous instance for every lot whose fields did not change
+        prev = self._by_name
+        lots: Lots = tuple([
+            old if (old := prev.get(lot.name)) == lot else lot
+            for _, lot in keyed
+        ])
+        self._by_name = {lot.name: lot for lot in lots}
 
         self._value = lots
+        self._pages = self._render_pages(lots)
+        self._body_hash = body_hash
+        self._remember_validators(resp)
         self._expires_at = now + self.ttl_seconds
         return lots
+
+    # stores the feed's ETag / Last-Modified so the next download can be conditional
+    # (only called once the body has been handled, so a failed parse is retried in full)
+    def _remember_validators(self, resp: requests.Response) -> None:
+        self._etag = resp.headers.get("ETag")
+        self._last_modified = resp.headers.get("Last-Modified")